@@ -0,0 +1,255 @@
+"""
+Rolling-origin backtest of the forecasting models for every drug.
+
+Reproduces the model comparison in Drug_Demand_Prediction/results from the
+current demand history (database, or monthly_demand.csv as a fallback) and
+records the best model per drug so the API can route to it:
+
+    python backtest.py                       # 3 windows of 3 months, all CPUs
+    python backtest.py --windows 6 --horizon 1 --workers 4
+    python backtest.py --metric MAPE
+
+Writes, in Drug_Demand_Prediction/results:
+    backtest_metrics.csv    MAE/RMSE/MAPE/R2 per model and drug
+    backtest_timings.csv    cross-validation, fit and predict wall time per model
+    backtest_champions.csv  the winning model per drug
+
+StatsForecast models are scored with its native cross_validation, using the
+season length the API's autoets_season_length picks for the drug's full
+history (yearly seasonality from 24 months on). Each window trains on less
+than the served history: with the default 3 windows of 3 months a 24-month
+series is fitted on 15 to 21 months here and on 24 months in the API.
+
+SES is the API's own grid-searched implementation (app.ses_forecast), so its
+scores describe the model that is served for drugs routed to it. XGBoost is
+backtested with lag features; it needs the xgboost package from
+requirements.txt, and without it the run says so and the results leave
+XGBoost out. The LSTM and Transformer models are served by
+dashboards/forecast.py and are not refit here.
+"""
+import argparse
+import importlib.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from app import autoets_season_length, base, demand_data, prepare_series, ses_forecast
+
+RESULTS_DIR = f"{base}/results"
+METRICS = ("MAE", "RMSE", "MAPE", "R2")
+MIN_TRAIN_MONTHS = 12
+XGB_LAGS = 6
+
+
+def statsforecast_models(season_length):
+    """The StatsForecast model families compared per drug, by result name"""
+    from statsforecast.models import AutoARIMA, AutoETS, Naive, SeasonalNaive
+    models = {
+        "AutoARIMA": AutoARIMA(season_length=season_length),
+        "AutoETS": AutoETS(season_length=season_length),
+        "Naive": Naive(),
+    }
+    if season_length > 1:
+        models["SeasonalNaive"] = SeasonalNaive(season_length=season_length)
+    return models
+
+
+def score(y, y_hat):
+    """MAE, RMSE, MAPE (%) and R2 of one model's backtest predictions"""
+    y, y_hat = np.asarray(y, dtype=float), np.asarray(y_hat, dtype=float)
+    errors = y - y_hat
+    nonzero = y != 0
+    total = np.sum((y - y.mean()) ** 2)
+    return {
+        "MAE": float(np.mean(np.abs(errors))),
+        "RMSE": float(np.sqrt(np.mean(errors ** 2))),
+        "MAPE": float(np.mean(np.abs(errors[nonzero] / y[nonzero])) * 100) if nonzero.any() else np.nan,
+        "R2": float(1 - np.sum(errors ** 2) / total) if total > 0 else np.nan,
+    }
+
+
+def backtest_statsforecast(series, horizon, windows, season_length):
+    """Cross-validated predictions and timings for every StatsForecast model on a panel"""
+    from statsforecast import StatsForecast
+    predictions, timings = [], {}
+    for name, model in statsforecast_models(season_length).items():
+        sf = StatsForecast(models=[model], freq="MS", n_jobs=1)
+        start = time.perf_counter()
+        cv = sf.cross_validation(h=horizon, df=series, n_windows=windows, step_size=horizon)
+        cv_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sf.fit(series)
+        fit_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        sf.predict(h=horizon)
+        predict_seconds = time.perf_counter() - start
+
+        predictions.append(cv[["unique_id", "ds", "y"]].assign(model=name, y_hat=cv[model.alias].to_numpy()))
+        timings[name] = (cv_seconds, fit_seconds, predict_seconds)
+    return predictions, timings
+
+
+def backtest_ses(series, horizon, windows):
+    """Rolling-origin predictions and timings for the SES implementation the API serves"""
+    predictions = []
+    cv_seconds = fit_seconds = 0.0
+    for unique_id, drug in series.groupby("unique_id", sort=False):
+        y, ds = drug["y"].to_numpy(dtype=float), drug["ds"].to_numpy()
+        for window in range(windows, -1, -1):
+            cutoff = len(y) - window * horizon
+            start = time.perf_counter()
+            # Fitting and forecasting are one step: the forecast is the final smoothed level
+            y_hat = ses_forecast(y[:cutoff], horizon)
+            if window == 0:
+                fit_seconds += time.perf_counter() - start
+            else:
+                cv_seconds += time.perf_counter() - start
+                predictions.append(pd.DataFrame({
+                    "unique_id": unique_id, "ds": ds[cutoff:cutoff + horizon], "y": y[cutoff:cutoff + horizon],
+                    "model": "SES", "y_hat": y_hat,
+                }))
+    return predictions, {"SES": (cv_seconds, fit_seconds, 0.0)}
+
+
+def lag_matrix(y, lags):
+    """Rows of the previous `lags` values (oldest first) and the value that followed them"""
+    windows = np.lib.stride_tricks.sliding_window_view(y, lags + 1)
+    return windows[:, :-1], windows[:, -1]
+
+
+def backtest_xgboost(series, horizon, windows):
+    """Rolling-origin predictions and timings for a per-drug XGBoost model on lag features"""
+    from xgboost import XGBRegressor
+    predictions = []
+    cv_seconds = fit_seconds = predict_seconds = 0.0
+    for unique_id, drug in series.groupby("unique_id", sort=False):
+        y, ds = drug["y"].to_numpy(dtype=float), drug["ds"].to_numpy()
+        for window in range(windows, -1, -1):
+            cutoff = len(y) - window * horizon
+            train = y[:cutoff]
+            start = time.perf_counter()
+            model = XGBRegressor(n_estimators=100, max_depth=3, learning_rate=0.1, n_jobs=1)
+            model.fit(*lag_matrix(train, XGB_LAGS))
+            fitted = time.perf_counter()
+            # Recursive multi-step forecast: each prediction becomes the next lag
+            history = list(train[-XGB_LAGS:])
+            y_hat = []
+            for _ in range(horizon):
+                y_hat.append(float(model.predict(np.array([history[-XGB_LAGS:]]))[0]))
+                history.append(y_hat[-1])
+            done = time.perf_counter()
+            if window == 0:
+                # Final fit on the full series, as the API would use it
+                fit_seconds += fitted - start
+                predict_seconds += done - fitted
+            else:
+                cv_seconds += done - start
+                predictions.append(pd.DataFrame({
+                    "unique_id": unique_id, "ds": ds[cutoff:cutoff + horizon], "y": y[cutoff:cutoff + horizon],
+                    "model": "XGBoost", "y_hat": y_hat,
+                }))
+    return predictions, {"XGBoost": (cv_seconds, fit_seconds, predict_seconds)}
+
+
+def backtest_chunk(series, horizon, windows):
+    """Backtest one chunk of drugs in a worker process; returns (metrics rows, timings)"""
+    predictions, timings = [], {}
+    # The API's rule on the full series, so each drug is scored with the season length it is served with
+    months = series.groupby("unique_id")["y"].transform("size")
+    season_lengths = months.map(lambda n: autoets_season_length(n) or 1)
+    for season_length, panel in series.groupby(season_lengths.to_numpy()):
+        chunk_predictions, chunk_timings = backtest_statsforecast(panel, horizon, windows, int(season_length))
+        predictions.extend(chunk_predictions)
+        for name, seconds in chunk_timings.items():
+            timings[name] = tuple(np.add(timings.get(name, (0.0, 0.0, 0.0)), seconds))
+
+    chunk_predictions, chunk_timings = backtest_ses(series, horizon, windows)
+    predictions.extend(chunk_predictions)
+    timings.update(chunk_timings)
+
+    try:
+        chunk_predictions, chunk_timings = backtest_xgboost(series, horizon, windows)
+        predictions.extend(chunk_predictions)
+        timings.update(chunk_timings)
+    except ImportError:
+        pass
+
+    rows = []
+    for (name, unique_id), group in pd.concat(predictions).groupby(["model", "unique_id"], sort=False):
+        rows.append(dict(Model=name, Drug=unique_id, **score(group["y"], group["y_hat"])))
+    return rows, timings
+
+
+def load_series(horizon, windows):
+    """Prepared monthly series with enough regular history for the requested backtest"""
+    history = demand_data()
+    series = prepare_series(history.assign(unique_id=history["drug_name"]))
+    sizes = series.groupby("unique_id")["ds"].agg(["size", "min", "max"])
+    span = (sizes["max"].dt.year - sizes["min"].dt.year) * 12 + sizes["max"].dt.month - sizes["min"].dt.month + 1
+    usable = sizes.index[(span == sizes["size"]) & (sizes["size"] >= MIN_TRAIN_MONTHS + horizon * windows)]
+    skipped = len(sizes) - len(usable)
+    if skipped:
+        print(f"Skipping {skipped} drugs with gaps or fewer than {MIN_TRAIN_MONTHS + horizon * windows} months")
+    return series[series["unique_id"].isin(usable)]
+
+
+def pick_champions(metrics, metric):
+    """Best model per drug: lowest error metric, or highest R2"""
+    ranked = metrics.dropna(subset=[metric]).sort_values(metric, ascending=(metric != "R2"))
+    champions = ranked.drop_duplicates("Drug").sort_values("Drug")
+    return champions[["Drug", "Model", *METRICS]].assign(Metric=metric)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest forecasting models per drug and pick a champion")
+    parser.add_argument("--horizon", type=int, default=3, help="months forecast from each origin")
+    parser.add_argument("--windows", type=int, default=3, help="number of rolling origins")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--metric", choices=METRICS, default="MAE", help="metric that picks the champion")
+    parser.add_argument("--output", default=RESULTS_DIR, help="directory for the result CSV files")
+    args = parser.parse_args()
+
+    series = load_series(args.horizon, args.windows)
+    drugs = series["unique_id"].unique()
+    if len(drugs) == 0:
+        print("No drug has enough history to backtest")
+        return
+
+    # A few chunks per worker keeps the pool busy when some drugs are slower to fit
+    chunks = [series[series["unique_id"].isin(part)] for part in np.array_split(drugs, min(len(drugs), args.workers * 4))]
+    print(f"Backtesting {len(drugs)} drugs in {len(chunks)} chunks on {args.workers} workers")
+    if importlib.util.find_spec("xgboost") is None:
+        print("xgboost is not installed: XGBoost is NOT evaluated and is missing from the results")
+
+    rows, timings = [], {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as pool:
+        for chunk_rows, chunk_timings in pool.map(backtest_chunk, chunks, [args.horizon] * len(chunks),
+                                                  [args.windows] * len(chunks)):
+            rows.extend(chunk_rows)
+            for name, seconds in chunk_timings.items():
+                timings[name] = tuple(np.add(timings.get(name, (0.0, 0.0, 0.0)), seconds))
+    print(f"Backtest finished in {time.perf_counter() - start:.1f}s")
+
+    os.makedirs(args.output, exist_ok=True)
+    metrics = pd.DataFrame(rows).sort_values(["Drug", "Model"])
+    metrics.to_csv(f"{args.output}/backtest_metrics.csv", index=False)
+
+    timing_rows = [
+        {"Model": name, "Drugs": int((metrics["Model"] == name).sum()), "CVSeconds": cv,
+         "FitSeconds": fit, "PredictSeconds": predict}
+        for name, (cv, fit, predict) in timings.items()
+    ]
+    pd.DataFrame(timing_rows).to_csv(f"{args.output}/backtest_timings.csv", index=False)
+
+    champions = pick_champions(metrics, args.metric)
+    champions.to_csv(f"{args.output}/backtest_champions.csv", index=False)
+    print(champions["Model"].value_counts().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+-- Daily Demand Index
+-- Lets the LSTM service (dashboards/forecast.py) aggregate the 30 days of checkouts up to today per
+-- drug and department in SQL, reading only that window instead of every checkout row
+-- The index is only added when information_schema does not list it yet, so the script can be
+-- re-run safely on both MySQL and MariaDB
+
+USE system;
+
+DELIMITER //
+
+DROP PROCEDURE IF EXISTS add_checkout_history_index //
+CREATE PROCEDURE add_checkout_history_index()
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.STATISTICS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'drug_checkouts'
+                     AND INDEX_NAME = 'idx_checkout_history') THEN
+        -- Serves the 30-day range scan up to today with its daily SUM, and the any-history check
+        ALTER TABLE drug_checkouts ADD INDEX idx_checkout_history (drug_id, department, checkout_time, quantity_dispensed);
+    END IF;
+END //
+
+DELIMITER ;
+
+CALL add_checkout_history_index();
+DROP PROCEDURE add_checkout_history_index;
+
+SELECT 'Daily demand index created.' AS message;
@@ -3,10 +3,13 @@ from flask_cors import CORS
 import pandas as pd
 import numpy as np
 import mysql.connector
-from tensorflow.keras.models import load_model
 import joblib
 import datetime
 import logging
+import os
+import sys
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -14,13 +17,102 @@ CORS(app)  # Enable CORS for all routes
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load the LSTM model and scaler
-try:
-    model = load_model("all_drugs_lstm_model.h5")
-    scaler = joblib.load("scaler_all_drugs.joblib")
-except Exception as e:
-    logging.error(f"Failed to load model or scaler: {str(e)}")
-    raise
+SEQUENCE_LENGTH = 30
+MODEL_PATH = os.environ.get("LSTM_MODEL_PATH", "all_drugs_lstm_model.h5")
+SCALER_PATH = os.environ.get("LSTM_SCALER_PATH", "scaler_all_drugs.joblib")
+TFLITE_PATH = os.environ.get("LSTM_TFLITE_PATH", "all_drugs_lstm_model.tflite")
+# "keras" serves the .h5 model; "tflite" serves the exported TFLITE_PATH model, which needs far less RAM
+LSTM_RUNTIME = os.environ.get("LSTM_RUNTIME", "keras")
+
+class LSTMModel:
+    """The LSTM model and scaler, loaded and warmed up once per worker process"""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.ready = threading.Event()
+        self.error = None
+        self.load_seconds = None
+        self.scaler = None
+        self._model = None
+        self._interpreter = None
+        self._input_shape = None
+        # The TFLite interpreter holds per-call tensor state and is not thread-safe
+        self._lock = threading.Lock()
+        self._loading_pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Load in a background thread, once per process: a thread started before a fork is not in the child"""
+        with self._start_lock:
+            if self._loading_pid == os.getpid():
+                return
+            self._loading_pid = os.getpid()
+        threading.Thread(target=self.load, name="lstm-model-load", daemon=True).start()
+
+    def load(self):
+        start = time.perf_counter()
+        try:
+            self.scaler = joblib.load(SCALER_PATH)
+            if self.runtime == "tflite":
+                try:
+                    from tflite_runtime.interpreter import Interpreter
+                except ImportError:
+                    from tensorflow.lite import Interpreter
+                self._interpreter = Interpreter(model_path=TFLITE_PATH)
+            else:
+                from tensorflow.keras.models import load_model
+                self._model = load_model(MODEL_PATH)
+            # A dummy batch traces the graph / allocates tensors before the first real request
+            self.predict(np.zeros((1, SEQUENCE_LENGTH, 1), dtype=np.float32))
+        except Exception as e:
+            self.error = str(e)
+            logging.error(f"Failed to load model or scaler: {str(e)}")
+            return
+        self.load_seconds = round(time.perf_counter() - start, 3)
+        self.ready.set()
+        logging.info(f"LSTM model ready ({self.runtime}) in {self.load_seconds}s")
+
+    def predict(self, batch):
+        """Scaled model output for a (n, SEQUENCE_LENGTH, 1) batch"""
+        batch = np.asarray(batch, dtype=np.float32)
+        if self._interpreter is None:
+            return self._model.predict(batch, verbose=0)
+        with self._lock:
+            input_index = self._interpreter.get_input_details()[0]["index"]
+            if self._input_shape != batch.shape:
+                # Re-allocating is only needed when the batch size changes
+                self._interpreter.resize_tensor_input(input_index, batch.shape)
+                self._interpreter.allocate_tensors()
+                self._input_shape = batch.shape
+            self._interpreter.set_tensor(input_index, batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._interpreter.get_output_details()[0]["index"]).copy()
+
+def export_tflite():
+    """Convert the Keras model at MODEL_PATH to a TFLite model at TFLITE_PATH"""
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(MODEL_PATH))
+    # LSTM layers need the TF ops fallback unless they were built with a fixed batch size
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    converter._experimental_lower_tensor_list_ops = False
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(TFLITE_PATH, "wb") as f:
+        f.write(converter.convert())
+    logging.info(f"Exported {MODEL_PATH} to {TFLITE_PATH}")
+
+# Loaded in the background so the worker accepts requests (and answers /ready) while TensorFlow starts
+MODEL = LSTMModel(LSTM_RUNTIME)
+
+@app.before_request
+def start_model_load():
+    # Started by each worker's first request rather than at import: with gunicorn --preload the import
+    # runs in the master process, and a loading thread started there never runs in the forked workers
+    MODEL.start()
+
+def not_ready_response():
+    if MODEL.error:
+        return jsonify({"error": f"Model failed to load: {MODEL.error}"}), 503
+    return jsonify({"error": "Model is still loading"}), 503
 
 def get_db_connection():
     try:
@@ -34,8 +126,91 @@ def get_db_connection():
         logging.error(f"Database connection failed: {str(e)}")
         raise
 
+# Upper bound on drug/department pairs in one /forecast/batch call
+MAX_BATCH_SIZE = 500
+
+def fetch_history(cursor, drug_id, department):
+    """Daily dispensed totals for the SEQUENCE_LENGTH days up to today, zero-filled; [] if never checked out"""
+    # The window ends today, where the forecast starts, so old demand is not projected as current.
+    # The bounds and the sums come from idx_checkout_history (daily_demand_index.sql),
+    # so at most SEQUENCE_LENGTH rows are returned however long the checkout history is
+    cursor.execute("""SELECT DATEDIFF(CURDATE(), DATE(checkout_time)) AS DaysBack,
+                             SUM(quantity_dispensed) AS QuantityDispensed
+                        FROM drug_checkouts
+                        WHERE drug_id = %s AND department = %s
+                          AND checkout_time >= CURDATE() - INTERVAL %s DAY
+                          AND checkout_time < CURDATE() + INTERVAL 1 DAY
+                        GROUP BY DaysBack
+                    """, (drug_id, department, SEQUENCE_LENGTH - 1))
+    rows = cursor.fetchall()
+    if not rows:
+        # No checkouts in the last SEQUENCE_LENGTH days is zero recent demand, not missing history
+        cursor.execute("SELECT 1 AS Found FROM drug_checkouts WHERE drug_id = %s AND department = %s LIMIT 1",
+                       (drug_id, department))
+        if not cursor.fetchall():
+            return []
+    # Days without checkouts are zero demand, not missing data
+    quantities = [0.0] * SEQUENCE_LENGTH
+    for row in rows:
+        quantities[SEQUENCE_LENGTH - 1 - int(row["DaysBack"])] = float(row["QuantityDispensed"])
+    return quantities
+
+def build_sequence(quantities):
+    """Scaled model input of the last SEQUENCE_LENGTH quantities, zero-padded at the front"""
+    scaled_values = MODEL.scaler.transform(np.asarray(quantities, dtype=float).reshape(-1, 1))
+    if len(scaled_values) < SEQUENCE_LENGTH:
+        logging.warning(f"Insufficient data points: {len(scaled_values)}. Padding with zeros.")
+        padding = np.zeros((SEQUENCE_LENGTH - len(scaled_values), 1))
+        scaled_values = np.vstack((padding, scaled_values))
+    return scaled_values[-SEQUENCE_LENGTH:]
+
+def predict_sequences(sequences):
+    """Unscaled forecasts for a stack of input sequences in a single model call"""
+    batch = np.stack(sequences)
+    logging.debug(f"Input batch shape: {batch.shape}")
+    y_pred_scaled = MODEL.predict(batch)
+    # The scaler works element-wise, so the whole batch is inverse-scaled at once
+    return MODEL.scaler.inverse_transform(y_pred_scaled)
+
+def forecast_rows(drug_id, drug_name, department, predictions, today):
+    """Forecast records for one drug and department, one per day from tomorrow"""
+    return [{
+        "DrugID": drug_id,
+        "DrugName": drug_name,
+        "Department": department,
+        "ForecastDate": (today + datetime.timedelta(days=i+1)).isoformat(),
+        "PredictedDemand": int(max(0, qty))  # Ensure no negative values
+    } for i, qty in enumerate(predictions)]
+
+def save_forecasts(forecast_results):
+    """Insert all forecast rows with one executemany in a single transaction"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        conn.start_transaction()
+        cursor.executemany("""
+            INSERT INTO Forecasts (DrugID, DrugName, Department, ForecastDate, PredictedDemand)
+            VALUES (%s, %s, %s, %s, %s)
+        """, [(f["DrugID"], f["DrugName"], f["Department"], f["ForecastDate"], f["PredictedDemand"])
+              for f in forecast_results])
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logging.debug(f"{len(forecast_results)} forecasts saved to database")
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    if not MODEL.ready.is_set():
+        return not_ready_response()
+    return jsonify({"status": "ready", "runtime": MODEL.runtime, "load_seconds": MODEL.load_seconds})
+
 @app.route('/forecast', methods=['POST'])
 def forecast():
+    if not MODEL.ready.is_set():
+        return not_ready_response()
     try:
         data = request.json
         logging.debug(f"Received payload: {data}")
@@ -49,80 +224,87 @@ def forecast():
 
         # Pull historical usage data from DB
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""SELECT t.checkout_time AS Date, t.quantity_dispensed AS QuantityDispensed, d.current_stock AS StockOnHand
-                            FROM drug_checkouts t
-                            INNER JOIN drugs d ON t.id = d.id
-                            WHERE t.id = %s AND t.Department = %s
-                            ORDER BY d.expiry_date
-                        """, (drug_id, department))
-        rows = cursor.fetchall()
-        logging.debug(f"Database rows fetched: {len(rows)} rows")
+        quantities = fetch_history(conn.cursor(dictionary=True), drug_id, department)
+        logging.debug(f"Daily demand fetched: {len(quantities)} days")
         conn.close()
 
-        if not rows:
+        if not quantities:
             logging.warning(f"No historical data found for DrugID={drug_id}, Department={department}")
             return jsonify({"error": "No historical data found"}), 404
 
-        # Prepare data for prediction
-        df = pd.DataFrame(rows)
-        values = df["QuantityDispensed"].values.reshape(-1, 1)
-        logging.debug(f"Raw data shape: {values.shape}")
-
-        # Scale the data
-        scaled_values = scaler.transform(values)
-        logging.debug(f"Scaled data shape: {scaled_values.shape}")
+        y_pred = predict_sequences([build_sequence(quantities)])
+        forecast_results = forecast_rows(drug_id, drug_name, department, y_pred[0], datetime.date.today())
+        save_forecasts(forecast_results)
 
-        # Ensure at least 30 data points for the sequence
-        if len(scaled_values) < 30:
-            logging.warning(f"Insufficient data points: {len(scaled_values)}. Padding with zeros.")
-            padding = np.zeros((30 - len(scaled_values), 1))
-            scaled_values = np.vstack((padding, scaled_values))
+        return jsonify({"message": "Forecasts saved successfully", "forecasts": forecast_results})
 
-        # Prepare input sequence (last 30 days)
-        sequence = np.array([scaled_values[-30:]])
-        logging.debug(f"Input sequence shape: {sequence.shape}")
+    except mysql.connector.Error as db_error:
+        logging.error(f"Database error: {str(db_error)}")
+        return jsonify({"error": f"Database error: {str(db_error)}"}), 500
+    except Exception as e:
+        logging.error(f"Unexpected error in forecast: {str(e)}")
+        return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
-        # Make prediction
-        y_pred_scaled = model.predict(sequence)
-        logging.debug(f"Prediction scaled shape: {y_pred_scaled.shape}")
+@app.route('/forecast/batch', methods=['POST'])
+def forecast_batch():
+    """Forecast many drug/department pairs with one model call and one insert transaction"""
+    if not MODEL.ready.is_set():
+        return not_ready_response()
+    try:
+        data = request.json or {}
+        items = data.get("items")
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Expected a non-empty 'items' list"}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} items per batch"}), 400
 
-        # Inverse scale to original values
-        y_pred = scaler.inverse_transform(y_pred_scaled)
-        logging.debug(f"Prediction unscaled shape: {y_pred.shape}")
+        # Results keep the request order; items that cannot be forecast carry an error instead
+        results = [None] * len(items)
+        pending, sequences = [], []
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            for i, item in enumerate(items):
+                drug_id = item.get("drug_id")
+                drug_name = item.get("drug_name")
+                department = item.get("department")
+                if not drug_id or not drug_name or not department:
+                    results[i] = {"error": "Missing required fields", "item": item}
+                    continue
+                quantities = fetch_history(cursor, drug_id, department)
+                if not quantities:
+                    results[i] = {"error": "No historical data found", "drug_id": drug_id, "department": department}
+                    continue
+                pending.append((i, drug_id, drug_name, department))
+                sequences.append(build_sequence(quantities))
+        finally:
+            conn.close()
+        logging.debug(f"Batch of {len(items)} items, {len(sequences)} with history")
 
-        # Generate forecast results
         forecast_results = []
-        today = datetime.date.today()
-        for i, qty in enumerate(y_pred[0]):
-            forecast_results.append({
-                "DrugID": drug_id,
-                "DrugName": drug_name,
-                "Department": department,
-                "ForecastDate": (today + datetime.timedelta(days=i+1)).isoformat(),
-                "PredictedDemand": int(max(0, qty))  # Ensure no negative values
-            })
-
-        # Save forecasts to MySQL
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        for f in forecast_results:
-            cursor.execute("""
-                INSERT INTO Forecasts (DrugID, DrugName, Department, ForecastDate, PredictedDemand)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (f["DrugID"], f["DrugName"], f["Department"], f["ForecastDate"], f["PredictedDemand"]))
-        conn.commit()
-        conn.close()
-        logging.debug("Forecasts saved to database")
+        if sequences:
+            y_pred = predict_sequences(sequences)
+            today = datetime.date.today()
+            for (i, drug_id, drug_name, department), predictions in zip(pending, y_pred):
+                rows = forecast_rows(drug_id, drug_name, department, predictions, today)
+                results[i] = {"drug_id": drug_id, "department": department, "forecasts": rows}
+                forecast_results.extend(rows)
+            save_forecasts(forecast_results)
 
-        return jsonify({"message": "Forecasts saved successfully", "forecasts": forecast_results})
+        return jsonify({"message": f"Saved {len(forecast_results)} forecasts for {len(sequences)} items",
+                        "results": results})
 
     except mysql.connector.Error as db_error:
         logging.error(f"Database error: {str(db_error)}")
         return jsonify({"error": f"Database error: {str(db_error)}"}), 500
     except Exception as e:
-        logging.error(f"Unexpected error in forecast: {str(e)}")
+        logging.error(f"Unexpected error in batch forecast: {str(e)}")
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000, debug=True)
\ No newline at end of file
+    if "--export-tflite" in sys.argv:
+        export_tflite()
+        sys.exit(0)
+    MODEL.start()
+    # The reloader would start a second process that loads its own copy of the model
+    app.run(host="127.0.0.1", port=5000, debug=True, use_reloader=False)
\ No newline at end of file
@@ -10,7 +10,7 @@ session_start();
 
 header('Content-Type: application/json');
 
-// Set longer execution time for processing multiple API calls
+// Set longer execution time for the batch prediction call
 set_time_limit(300); // 5 minutes
 
 try {
@@ -102,14 +102,16 @@ try {
 
     error_log("Found " . count($drugs) . " drugs for department: '$user_department'");
 
-    // Function to call prediction API
-    function getPrediction($drug_name) {
-        $api_url = "http://127.0.0.1:8000/predict/" . urlencode($drug_name);
+    // Function to call the batch prediction API once for every drug
+    function getPredictions($drug_names) {
+        $api_url = "http://127.0.0.1:8000/predict/batch";
         
         $context = stream_context_create([
             'http' => [
-                'method' => 'GET',
-                'timeout' => 15,
+                'method' => 'POST',
+                'header' => "Content-Type: application/json\r\n",
+                'content' => json_encode(['drugs' => array_values($drug_names)]),
+                'timeout' => 120,
                 'ignore_errors' => true
             ]
         ]);
@@ -118,37 +120,49 @@ try {
         
         if ($response === false) {
             $error = error_get_last();
-            error_log("API call failed for drug '$drug_name': " . ($error['message'] ?? 'Unknown error'));
-            return null;
+            error_log("Batch API call failed for " . count($drug_names) . " drugs: " . ($error['message'] ?? 'Unknown error'));
+            return [];
         }
         
         $data = json_decode($response, true);
         
         if (json_last_error() !== JSON_ERROR_NONE) {
-            error_log("JSON decode error for drug '$drug_name': " . json_last_error_msg());
-            return null;
+            error_log("JSON decode error for batch prediction: " . json_last_error_msg());
+            return [];
         }
         
-        if (isset($data['error'])) {
-            error_log("API returned error for drug '$drug_name': " . $data['error']);
-            return null;
+        if (!isset($data['forecasts']) || !is_array($data['forecasts'])) {
+            error_log("Batch API returned no forecasts: " . ($data['error'] ?? 'Unknown error'));
+            return [];
         }
         
-        // Calculate total demand for next 3 months
-        if (isset($data['predictions']) && is_array($data['predictions']) && count($data['predictions']) >= 3) {
-            $total_demand = array_sum(array_slice($data['predictions'], 0, 3));
-            return [
-                'total_demand' => round($total_demand, 2),
-                'month1' => isset($data['predictions'][0]) ? round($data['predictions'][0], 2) : 0,
-                'month2' => isset($data['predictions'][1]) ? round($data['predictions'][1], 2) : 0,
-                'month3' => isset($data['predictions'][2]) ? round($data['predictions'][2], 2) : 0,
-                'method' => $data['method'] ?? 'Unknown',
-                'historical_mean' => isset($data['historical_mean']) ? round($data['historical_mean'], 2) : null
-            ];
+        // Forecasts come back in request order, one per drug name
+        $predictions = [];
+        foreach (array_values($drug_names) as $i => $drug_name) {
+            $item = $data['forecasts'][$i] ?? null;
+            
+            if ($item === null || isset($item['error'])) {
+                error_log("API returned error for drug '$drug_name': " . ($item['error'] ?? 'missing forecast'));
+                continue;
+            }
+            
+            // Calculate total demand for next 3 months
+            if (isset($item['predictions']) && is_array($item['predictions']) && count($item['predictions']) >= 3) {
+                $total_demand = array_sum(array_slice($item['predictions'], 0, 3));
+                $predictions[$drug_name] = [
+                    'total_demand' => round($total_demand, 2),
+                    'month1' => isset($item['predictions'][0]) ? round($item['predictions'][0], 2) : 0,
+                    'month2' => isset($item['predictions'][1]) ? round($item['predictions'][1], 2) : 0,
+                    'month3' => isset($item['predictions'][2]) ? round($item['predictions'][2], 2) : 0,
+                    'method' => $item['method'] ?? 'Unknown',
+                    'historical_mean' => isset($item['historical_mean']) ? round($item['historical_mean'], 2) : null
+                ];
+            } else {
+                error_log("Invalid predictions data for drug '$drug_name': predictions array missing or incomplete");
+            }
         }
         
-        error_log("Invalid predictions data for drug '$drug_name': predictions array missing or incomplete");
-        return null;
+        return $predictions;
     }
 
     // Deduplicate drugs before processing
@@ -173,7 +187,10 @@ try {
     
     error_log("Processing " . count($drugs) . " unique drugs for department: '$user_department'");
 
-    // Get predictions for all unique drugs (optimize for admin - limit per department)
+    // Get predictions for all unique drugs in a single batch API call
+    $predictions = getPredictions(array_unique(array_column($drugs, 'drug_name')));
+
+    // Assemble forecasts (optimize for admin - limit per department)
     $forecasts = [];
     
     if ($is_admin) {
@@ -204,7 +221,7 @@ try {
                 }
                 
                 try {
-                    $prediction = getPrediction($drug['drug_name']);
+                    $prediction = $predictions[$drug['drug_name']] ?? null;
                     
                     if ($prediction !== null && isset($prediction['total_demand']) && $prediction['total_demand'] > 0) {
                         $dept_forecasts_list[] = [
@@ -228,9 +245,6 @@ try {
                     error_log("Exception processing drug '{$drug['drug_name']}' in department '$dept': " . $e->getMessage());
                     $errors++;
                 }
-                
-                // Reduced delay for admin (25ms instead of 50ms)
-                usleep(25000); // 25ms delay
             }
             
             // Sort department forecasts by total demand and keep top 15
@@ -259,7 +273,7 @@ try {
             }
             
             try {
-                $prediction = getPrediction($drug['drug_name']);
+                $prediction = $predictions[$drug['drug_name']] ?? null;
                 
                 if ($prediction !== null && isset($prediction['total_demand']) && $prediction['total_demand'] > 0) {
                     $forecasts[] = [
@@ -282,9 +296,6 @@ try {
                 error_log("Exception processing drug '{$drug['drug_name']}': " . $e->getMessage());
                 $errors++;
             }
-            
-            // Small delay to prevent overwhelming the API
-            usleep(50000); // 50ms delay
         }
         
         error_log("Processed $processed forecasts, $errors errors for department: '$user_department'");
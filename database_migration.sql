@@ -52,3 +52,6 @@ DELIMITER ;
 -- with proper error handling and transactions
 
 SELECT 'Migration completed. Please verify stock levels and adjust initial stock as needed.' AS message;
+
+-- The prediction API caches the drug_checkouts column layout; make it re-probe the new schema:
+--   curl -X POST http://127.0.0.1:8000/admin/refresh-schema
@@ -0,0 +1,60 @@
+-- Forecasts Table
+-- Precomputed forecasts shared by the AutoETS API (app.py) and the LSTM service (dashboards/forecast.py)
+-- The table is named Forecasts, as the LSTM service writes it: with case-sensitive table names
+-- (lower_case_table_names=0, the Linux default) `forecasts` would be a different table.
+-- Columns and the index are added through information_schema checks, so the script can be re-run
+-- on an existing Forecasts table on both MySQL and MariaDB.
+
+USE system;
+
+-- Same columns the LSTM service already writes
+CREATE TABLE IF NOT EXISTS Forecasts (
+    DrugID INT NULL,
+    DrugName VARCHAR(255) NOT NULL,
+    Department VARCHAR(255) NOT NULL DEFAULT '',
+    ForecastDate DATE NOT NULL,
+    PredictedDemand DOUBLE NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+DELIMITER //
+
+DROP PROCEDURE IF EXISTS add_forecasts_column //
+CREATE PROCEDURE add_forecasts_column(IN column_name VARCHAR(64), IN definition VARCHAR(255))
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.COLUMNS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Forecasts' AND COLUMN_NAME = column_name) THEN
+        SET @ddl = CONCAT('ALTER TABLE Forecasts ADD COLUMN ', column_name, ' ', definition);
+        PREPARE stmt FROM @ddl;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
+    END IF;
+END //
+
+DROP PROCEDURE IF EXISTS add_forecasts_index //
+CREATE PROCEDURE add_forecasts_index(IN index_name VARCHAR(64), IN index_columns VARCHAR(255))
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.STATISTICS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Forecasts' AND INDEX_NAME = index_name) THEN
+        SET @ddl = CONCAT('ALTER TABLE Forecasts ADD INDEX ', index_name, ' (', index_columns, ')');
+        PREPARE stmt FROM @ddl;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
+    END IF;
+END //
+
+DELIMITER ;
+
+-- Which service produced the row; rows inserted by the LSTM service without a Source are 'lstm'
+CALL add_forecasts_column('Source', "VARCHAR(32) NOT NULL DEFAULT 'lstm'");
+CALL add_forecasts_column('Method', 'VARCHAR(64) NULL');
+CALL add_forecasts_column('HistoricalMean', 'DOUBLE NULL');
+CALL add_forecasts_column('LastValue', 'DOUBLE NULL');
+CALL add_forecasts_column('ComputedAt', 'DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP');
+
+-- /predict/{drug} reads one drug's rows in month order
+CALL add_forecasts_index('idx_forecast_lookup', 'DrugName, Source, Department, ForecastDate');
+
+DROP PROCEDURE add_forecasts_column;
+DROP PROCEDURE add_forecasts_index;
+
+SELECT 'Forecasts table ready.' AS message;
@@ -0,0 +1,52 @@
+"""
+Background forecast worker for the Drug Demand Forecast API.
+
+Keeps the monthly_demand rollup, the Forecasts table and the department
+hierarchy current without the API process doing the work. Run it next to
+uvicorn and start the API with FORECAST_REFRESH_SECONDS=0 so forecasts are
+only computed here; the API workers pick the hierarchy up from the shared
+cache (SHARED_CACHE_URL must be file:// or redis:// for that):
+
+    python forecast_worker.py               # refresh on the default cadence
+    python forecast_worker.py --once        # one refresh, then exit
+    python forecast_worker.py --interval 600
+"""
+import argparse
+import time
+
+from app import (FORECAST_REFRESH_SECONDS, ROLLUP_REFRESH_SECONDS, refresh_all_forecasts, refresh_hierarchy,
+                 refresh_monthly_rollup)
+
+
+def refresh():
+    """Recompute the stored forecasts, then the hierarchy the API serves"""
+    refresh_all_forecasts()
+    refresh_hierarchy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute stored drug demand forecasts")
+    parser.add_argument("--once", action="store_true", help="refresh once and exit")
+    parser.add_argument("--interval", type=float, default=FORECAST_REFRESH_SECONDS or 3600,
+                        help="seconds between full forecast refreshes")
+    parser.add_argument("--rollup-interval", type=float, default=ROLLUP_REFRESH_SECONDS or 60,
+                        help="seconds between monthly rollup refreshes")
+    args = parser.parse_args()
+
+    refresh_monthly_rollup()
+    refresh()
+    if args.once:
+        return
+
+    last_full_refresh = time.monotonic()
+    while True:
+        time.sleep(args.rollup_interval)
+        # New checkouts in the rollup make the stored forecasts stale right away
+        rollup_changed = refresh_monthly_rollup() > 0
+        if rollup_changed or time.monotonic() - last_full_refresh >= args.interval:
+            refresh()
+            last_full_refresh = time.monotonic()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Streaming ingestion of drug transaction files.
+
+Reads a transactions CSV (same columns as Drug_Demand_Prediction/drug_transactions.csv)
+in chunks, rolls it up to monthly and daily demand as it goes, and optionally
+bulk-loads the rows into drug_checkouts and writes a Parquet cache:
+
+    python ingest_transactions.py                          # rollups + Parquet cache
+    python ingest_transactions.py --load-db                # also insert into drug_checkouts
+    python ingest_transactions.py --load-db --keep-stock   # historical backfill: leave drugs.current_stock as is
+    python ingest_transactions.py other.csv --chunksize 100000 --no-parquet
+
+Writes, in Drug_Demand_Prediction:
+    monthly_demand.parquet             month, drug_name, quantity (same as monthly_demand.csv)
+    department_monthly_demand.parquet  month, drug_name, department, quantity
+    daily_demand.parquet               day, drug_id, drug_name, department, quantity
+
+When monthly_demand.parquet is at least as new as monthly_demand.csv the API's
+CSV fallback (load_static_data) reads it instead, memory-mapped.
+
+Rows are inserted with the same columns as dashboards/checkout_drug.php (name is
+set to --checkout-name, since transaction files carry no user). drug_id comes from
+the drugs row with the same drug_name and department, as in the PHP checkout;
+rows without one are skipped and listed at the end. Like any checkout
+that has a drug_name, they fire the update_stock_on_checkout trigger from
+database_migration.sql and decrement drugs.current_stock. For a backfill of past
+transactions whose stock is already reflected, --keep-stock adds the quantities
+back in the same transaction.
+"""
+import argparse
+import time
+
+import pandas as pd
+import pymysql
+
+from app import DB_CONFIG, base, describe_checkout_columns
+
+DEFAULT_SOURCE = f"{base}/drug_transactions.csv"
+TRANSACTION_DTYPES = {
+    "drug_id": "int32",
+    "drug_name": "category",
+    "department": "category",
+    "quantity_dispensed": "int32",
+    "current_stock": "int32",
+    "expiry_date": "string",
+    "transaction_date": "string",
+}
+# Transaction files use US dates without zero padding, e.g. 6/7/2027
+DATE_FORMAT = "%m/%d/%Y"
+
+
+def parse_dates(chunk):
+    """Parse the M/D/YYYY date columns with an explicit format (no per-row format inference)"""
+    for column in ("transaction_date", "expiry_date"):
+        chunk[column] = pd.to_datetime(chunk[column], format=DATE_FORMAT, cache=True)
+    return chunk
+
+
+def rollup_chunk(chunk):
+    """Daily demand per drug and department for one chunk"""
+    # Sums are widened to int64 so monthly totals cannot overflow the int32 read dtype
+    daily = chunk.assign(day=chunk["transaction_date"].dt.normalize(),
+                         quantity_dispensed=chunk["quantity_dispensed"].astype("int64"))
+    return (daily.groupby(["day", "drug_id", "drug_name", "department"], observed=True, sort=False)
+            ["quantity_dispensed"].sum().rename("quantity").reset_index())
+
+
+def combine_rollups(partials):
+    """Merge per-chunk daily rollups (a day can span two chunks) and derive the monthly ones"""
+    daily = pd.concat(partials, ignore_index=True)
+    # Categories differ from chunk to chunk; plain strings group consistently
+    daily["drug_name"] = daily["drug_name"].astype(str)
+    daily["department"] = daily["department"].astype(str)
+    daily = (daily.groupby(["day", "drug_id", "drug_name", "department"], sort=True)["quantity"]
+             .sum().reset_index())
+    month = daily["day"].dt.to_period("M").dt.to_timestamp()
+    department_monthly = (daily.assign(month=month)
+                          .groupby(["month", "drug_name", "department"], sort=True)["quantity"]
+                          .sum().reset_index())
+    monthly = (department_monthly.groupby(["month", "drug_name"], sort=True)["quantity"]
+               .sum().reset_index())
+    return monthly, department_monthly, daily
+
+
+def drug_ids_by_department(cursor):
+    """drugs.drug_id per (drug_name, department), matched like MySQL's case-insensitive string compare"""
+    cursor.execute("SELECT drug_id, drug_name, department FROM drugs ORDER BY drug_id")
+    drug_ids = {}
+    for drug_id, drug_name, department in cursor.fetchall():
+        drug_ids.setdefault((str(drug_name).strip().lower(), str(department or "").strip().lower()), drug_id)
+    return drug_ids
+
+
+def checkout_insert(cursor, checkout_name):
+    """INSERT statement, row builder and drug matcher writing the same drug_checkouts columns as the PHP checkout
+
+    Like dashboards/checkout_drug.php, drug_id is looked up in drugs by drug_name and department
+    (fix_foreign_key.php makes it a foreign key); the file's own drug_id is not used.
+    """
+    columns = describe_checkout_columns(cursor)
+    drug_ids = drug_ids_by_department(cursor) if "drug_id" in columns else None
+
+    def match(chunk):
+        """(rows with their drugs.drug_id, rows whose drug and department have no drugs row)"""
+        if drug_ids is None:
+            return chunk, chunk.iloc[:0]
+        keys = zip(chunk["drug_name"].astype(str).str.strip().str.lower(),
+                   chunk["department"].astype(str).str.strip().str.lower())
+        ids = pd.Series([drug_ids.get(key) for key in keys], index=chunk.index, dtype="Int64")
+        found = ids.notna().to_numpy()
+        return chunk[found].assign(drug_id=ids[found].astype("int64")), chunk[~found]
+
+    builders = {
+        "drug_id": lambda chunk: chunk["drug_id"].tolist(),
+        # The update_stock_on_checkout trigger matches on drug_name
+        "drug_name": lambda chunk: chunk["drug_name"].astype(str).tolist(),
+        "quantity_dispensed" if "drug_id" in columns else "quantity":
+            lambda chunk: chunk["quantity_dispensed"].tolist(),
+        "name": lambda chunk: [checkout_name] * len(chunk),
+        "department": lambda chunk: chunk["department"].astype(str).tolist(),
+        "checkout_time": lambda chunk: chunk["transaction_date"].dt.to_pydatetime().tolist(),
+    }
+    names = [column for column in builders if column in columns]
+    sql = f"INSERT INTO drug_checkouts ({', '.join(names)}) VALUES ({', '.join(['%s'] * len(names))})"
+    return sql, lambda chunk: zip(*(builders[column](chunk) for column in names)), match
+
+
+def restore_stock(cursor, chunk):
+    """Add a chunk's quantities back to drugs.current_stock, undoing the checkout trigger"""
+    totals = (chunk.groupby(["drug_name", "department"], observed=True)["quantity_dispensed"]
+              .sum().reset_index())
+    cursor.executemany("UPDATE drugs SET current_stock = current_stock + %s WHERE drug_name = %s AND department = %s",
+                       list(zip(totals["quantity_dispensed"].astype("int64").tolist(),
+                                totals["drug_name"].astype(str).tolist(), totals["department"].astype(str).tolist())))
+
+
+def load_chunk(conn, sql, chunk, build_rows, batch_size, keep_stock=False):
+    """Insert one chunk with multi-row executemany batches, committed as one transaction"""
+    rows = list(build_rows(chunk))
+    with conn.cursor() as cursor:
+        try:
+            for start in range(0, len(rows), batch_size):
+                # pymysql rewrites INSERT ... VALUES executemany into multi-row statements
+                cursor.executemany(sql, rows[start:start + batch_size])
+            if keep_stock:
+                restore_stock(cursor, chunk)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(rows)
+
+
+def ingest(path, chunksize, load_db, batch_size, checkout_name="import", keep_stock=False):
+    """Stream the file once: per-chunk rollups and, optionally, bulk inserts"""
+    partials, unmatched, rows_read, rows_loaded = [], [], 0, 0
+    conn = sql = build_rows = match = None
+    if load_db:
+        conn = pymysql.connect(autocommit=False, **DB_CONFIG)
+        with conn.cursor() as cursor:
+            sql, build_rows, match = checkout_insert(cursor, checkout_name)
+            # Without a drug_name column there is no stock trigger to undo
+            keep_stock = keep_stock and "drug_name" in describe_checkout_columns(cursor)
+    try:
+        for chunk in pd.read_csv(path, dtype=TRANSACTION_DTYPES, chunksize=chunksize):
+            chunk = parse_dates(chunk)
+            partials.append(rollup_chunk(chunk))
+            rows_read += len(chunk)
+            if conn is not None:
+                matched, missing = match(chunk)
+                if len(missing):
+                    unmatched.append(missing.groupby(["drug_name", "department"], observed=True).size())
+                rows_loaded += load_chunk(conn, sql, matched, build_rows, batch_size, keep_stock)
+    finally:
+        if conn is not None:
+            conn.close()
+    if unmatched:
+        unmatched = pd.concat(unmatched).groupby(level=[0, 1], observed=True).sum().sort_values(ascending=False)
+    return partials, rows_read, rows_loaded, unmatched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream drug transactions into rollups, Parquet and drug_checkouts")
+    parser.add_argument("path", nargs="?", default=DEFAULT_SOURCE, help="transactions CSV file")
+    parser.add_argument("--chunksize", type=int, default=50000, help="rows read per chunk")
+    parser.add_argument("--load-db", action="store_true", help="insert the transactions into drug_checkouts")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per executemany batch")
+    parser.add_argument("--checkout-name", default="import", help="value for drug_checkouts.name")
+    parser.add_argument("--keep-stock", action="store_true",
+                        help="undo the stock trigger's decrement (for transactions already reflected in current_stock)")
+    parser.add_argument("--no-parquet", action="store_true", help="skip writing the Parquet cache")
+    parser.add_argument("--output", default=base, help="directory for the Parquet files")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    partials, rows_read, rows_loaded, unmatched = ingest(args.path, args.chunksize, args.load_db, args.batch_size,
+                                              args.checkout_name, args.keep_stock)
+    if not partials:
+        print(f"No transactions in {args.path}")
+        return
+    monthly, department_monthly, daily = combine_rollups(partials)
+    print(f"Read {rows_read} transactions in {len(partials)} chunks: {len(monthly)} drug-months, "
+          f"{len(daily)} drug-department-days")
+    if args.load_db:
+        print(f"Inserted {rows_loaded} rows into drug_checkouts"
+              + (" (drugs.current_stock left unchanged)" if args.keep_stock else ""))
+        if len(unmatched):
+            print(f"Skipped {int(unmatched.sum())} rows whose drug and department are not in the drugs table:")
+            for (drug_name, department), count in unmatched.head(20).items():
+                print(f"    {drug_name} / {department}: {count}")
+            if len(unmatched) > 20:
+                print(f"    ... and {len(unmatched) - 20} more drug/department pairs")
+
+    if not args.no_parquet:
+        monthly.to_parquet(f"{args.output}/monthly_demand.parquet", index=False)
+        department_monthly.to_parquet(f"{args.output}/department_monthly_demand.parquet", index=False)
+        daily.to_parquet(f"{args.output}/daily_demand.parquet", index=False)
+        print(f"Wrote Parquet cache to {args.output}")
+    print(f"Ingestion finished in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# app reads its configuration at import time: keep it in-process and off the background loops
+os.environ.setdefault("SHARED_CACHE_URL", "memory")
+os.environ.setdefault("FIT_WORKERS", "0")
+os.environ.setdefault("FORECAST_REFRESH_SECONDS", "0")
+os.environ.setdefault("ROLLUP_REFRESH_SECONDS", "0")
+os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def demand_history(series, months=24):
+    """Monthly history with a steady, slightly noisy level for each (drug, department, level)"""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2023-01-01", periods=months, freq="MS")
+    return pd.DataFrame([
+        {"month": month, "drug_name": drug, "department": department, "quantity": level + rng.normal(0, 1)}
+        for drug, department, level in series for month in dates
+    ])
+
+
+def assert_coherent(result):
+    nodes = result["nodes"].values()
+    bottom = [node for node in nodes if node["level"] == "drug_department"]
+    total = result["nodes"][(None, None)]["predictions"]
+    assert np.allclose(total, np.sum([node["predictions"] for node in bottom], axis=0), atol=0.05)
+    for drug in result["drugs"]:
+        drug_total = result["nodes"][(drug.lower(), None)]["predictions"]
+        parts = [node["predictions"] for node in bottom if node["drug"] == drug]
+        assert np.allclose(drug_total, np.sum(parts, axis=0), atol=0.05)
+    for department in result["departments"]:
+        department_total = result["nodes"][(None, department.lower())]["predictions"]
+        parts = [node["predictions"] for node in bottom if node["department"] == department]
+        assert np.allclose(department_total, np.sum(parts, axis=0), atol=0.05)
+
+
+def test_hierarchy_is_coherent():
+    result = app.compute_hierarchy(demand_history([
+        ("Amoxicillin", "Pediatrics", 35), ("Amoxicillin", "Surgery", 35), ("Ibuprofen", "Surgery", 35),
+    ]), h=3)
+    assert len(result["nodes"]) == 1 + 2 + 2 + 3
+    assert_coherent(result)
+    assert result["nodes"][(None, None)]["predictions"] == pytest.approx([105] * 3, abs=3)
+
+
+@pytest.mark.parametrize("blank", ["", None, "  "])
+def test_blank_department_keeps_the_totals(blank):
+    result = app.compute_hierarchy(demand_history([
+        ("Amoxicillin", "Pediatrics", 35), ("Amoxicillin", blank, 35), ("Ibuprofen", "Surgery", 35),
+    ]), h=3)
+    assert_coherent(result)
+    # The blank department is a node of its own, not the hospital or drug total
+    assert result["nodes"][(None, None)]["predictions"] == pytest.approx([105] * 3, abs=3)
+    assert result["nodes"][("amoxicillin", None)]["predictions"] == pytest.approx([70] * 3, abs=3)
+    unassigned = app.UNASSIGNED_DEPARTMENT.lower()
+    assert result["nodes"][(None, unassigned)]["level"] == "department"
+    assert result["nodes"][("amoxicillin", unassigned)]["level"] == "drug_department"
+    assert app.UNASSIGNED_DEPARTMENT in result["departments"]
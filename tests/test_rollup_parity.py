@@ -0,0 +1,54 @@
+from datetime import date
+
+import pytest
+
+import app
+
+TODAY = "2026-10-18"
+
+
+def test_every_layout_uses_the_same_month_start_window():
+    for layout in ("rollup", "drug_id", "drug_name"):
+        queries = app.compile_demand_queries(layout)
+        for name in ("all", "departments", "exact"):
+            assert f">= {app.DEMAND_WINDOW_START}" in queries[name]
+    # pymysql formats queries with parameters, so the bound must not contain a bare '%'
+    assert "%" not in app.DEMAND_WINDOW_START
+
+
+def test_window_starts_on_a_month_boundary():
+    assert app.demand_window_start(TODAY) == app.pd.Timestamp("2024-10-01")
+    assert app.demand_window_start("2026-10-01") == app.pd.Timestamp("2024-10-01")
+
+
+def test_matching_history_has_no_mismatches():
+    # The rollup returns DATE values, the raw layouts 'YYYY-MM-01' strings
+    rollup = [{"month": date(2024, 10, 1), "drug_name": "Amoxicillin", "quantity": 40},
+              {"month": date(2026, 9, 1), "drug_name": "Amoxicillin", "quantity": 55}]
+    raw = [{"month": "2024-10-01", "drug_name": " amoxicillin ", "quantity": 40},
+           {"month": "2026-09-01", "drug_name": "Amoxicillin", "quantity": 55}]
+    compared, mismatches = app.compare_monthly_demand(rollup, raw, today=TODAY)
+    assert len(compared) == 2
+    assert mismatches.empty
+
+
+def test_only_complete_months_in_the_window_are_compared():
+    rollup = [{"month": date(2024, 10, 1), "drug_name": "Amoxicillin", "quantity": 40},
+              {"month": date(2026, 10, 1), "drug_name": "Amoxicillin", "quantity": 3}]
+    raw = [{"month": "2024-09-01", "drug_name": "Amoxicillin", "quantity": 12},  # before the window
+           {"month": "2024-10-01", "drug_name": "Amoxicillin", "quantity": 40},
+           {"month": "2026-10-01", "drug_name": "Amoxicillin", "quantity": 9}]  # still filling up
+    compared, mismatches = app.compare_monthly_demand(rollup, raw, today=TODAY)
+    assert list(compared.index.get_level_values("month").strftime("%Y-%m")) == ["2024-10"]
+    assert mismatches.empty
+
+
+def test_differences_beyond_tolerance_are_reported():
+    rollup = [{"month": date(2025, 3, 1), "drug_name": "Ibuprofen", "quantity": 100},
+              {"month": date(2025, 4, 1), "drug_name": "Ibuprofen", "quantity": 100}]
+    raw = [{"month": "2025-03-01", "drug_name": "Ibuprofen", "quantity": 99},
+           {"month": "2025-04-01", "drug_name": "Ibuprofen", "quantity": 90},
+           {"month": "2025-04-01", "drug_name": "Paracetamol", "quantity": 7}]
+    _, mismatches = app.compare_monthly_demand(rollup, raw, tolerance=1, today=TODAY)
+    assert mismatches[["drug_name", "month"]].values.tolist() == [["ibuprofen", "2025-04"], ["paracetamol", "2025-04"]]
+    assert mismatches["difference"].tolist() == pytest.approx([10, -7])
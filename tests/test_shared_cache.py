@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import app
+
+
+def file_cache(directory, check_seconds=0.0):
+    """A worker's view of a shared file cache; several of them on one folder act like several workers"""
+    return app.SharedCache(app.FileCacheBackend(str(directory)), "test", check_seconds=check_seconds)
+
+
+def claim_in_process(directory):
+    return file_cache(directory).claim("hierarchy", "compute|1", 60)
+
+
+def test_values_and_frames_round_trip(tmp_path):
+    cache = file_cache(tmp_path / "cache")
+    cache.set("hierarchy", "result", (3, {"nodes": {(None, None): [1.0, 2.0]}}))
+    assert cache.get("hierarchy", "result") == (3, {"nodes": {(None, None): [1.0, 2.0]}})
+    frame = pd.DataFrame({"drug_name": ["a", "b"], "quantity": [1.5, 2.0]})
+    cache.set_frame("demand", "monthly", frame)
+    pd.testing.assert_frame_equal(file_cache(tmp_path / "cache").get_frame("demand", "monthly"), frame)
+    assert cache.get("hierarchy", "missing") is None
+
+
+def test_invalidate_bumps_the_version_for_every_worker(tmp_path):
+    worker, other = file_cache(tmp_path / "cache"), file_cache(tmp_path / "cache")
+    assert worker.version("demand") == 0
+    worker.set("demand", "entry", "old")
+    assert other.get("demand", "entry") == "old"
+
+    version = other.invalidate("demand")
+    assert version > 0
+    assert worker.version("demand") == version
+    assert worker.get("demand", "entry") is None
+    # Entries of the superseded version are removed, not just hidden
+    assert not [name for name in os.listdir(tmp_path / "cache") if "_v0_" in name]
+    # Other namespaces keep their version
+    assert worker.version("forecasts") == 0
+
+
+def test_versions_are_rechecked_after_check_seconds(tmp_path):
+    worker, other = file_cache(tmp_path / "cache", check_seconds=0.2), file_cache(tmp_path / "cache")
+    assert worker.version("demand") == 0
+    version = other.invalidate("demand")
+    assert worker.version("demand") == 0
+    time.sleep(0.25)
+    assert worker.version("demand") == version
+
+
+def test_versions_keep_increasing(tmp_path):
+    worker, other = file_cache(tmp_path / "cache"), file_cache(tmp_path / "cache")
+    versions = [worker.invalidate("demand"), other.invalidate("demand"), worker.invalidate("demand")]
+    assert versions == sorted(set(versions))
+
+
+def test_only_one_worker_wins_a_claim(tmp_path):
+    worker, other = file_cache(tmp_path / "cache"), file_cache(tmp_path / "cache")
+    assert worker.claim("hierarchy", "compute|1", 60)
+    assert not other.claim("hierarchy", "compute|1", 60)
+    assert not worker.claim("hierarchy", "compute|1", 60)
+    # A different key, e.g. the next demand version, is claimed independently
+    assert other.claim("hierarchy", "compute|2", 60)
+
+
+def test_released_and_expired_claims_can_be_claimed_again(tmp_path):
+    worker, other = file_cache(tmp_path / "cache"), file_cache(tmp_path / "cache")
+    assert worker.claim("forecasts", "refresh|1", 60)
+    worker.release("forecasts", "refresh|1")
+    assert other.claim("forecasts", "refresh|1", 60)
+
+    assert worker.claim("forecasts", "refresh|2", 0.1)
+    time.sleep(1.1)  # file modification times can be whole seconds
+    assert other.claim("forecasts", "refresh|2", 0.1)
+
+
+def test_claims_are_exclusive_across_processes(tmp_path):
+    (tmp_path / "cache").mkdir(mode=0o700)
+    with multiprocessing.get_context("fork").Pool(8) as pool:
+        results = pool.map(claim_in_process, [tmp_path / "cache"] * 8)
+    assert results.count(True) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX permissions")
+def test_folder_open_to_other_users_is_refused(tmp_path):
+    directory = tmp_path / "shared"
+    directory.mkdir()
+    directory.chmod(0o755)
+    with pytest.raises(PermissionError):
+        app.FileCacheBackend(str(directory))